@@ -1,17 +1,28 @@
 import os
 from typing import Optional
 from dataclasses import dataclass
+from functools import cached_property, lru_cache
 
-@dataclass
+
+def _env_int(name: str, default: int) -> int:
+    """Читает целочисленную переменную окружения"""
+    return int(os.getenv(name, str(default)))
+
+
+def _env_float(name: str, default: float) -> float:
+    """Читает вещественную переменную окружения"""
+    return float(os.getenv(name, str(default)))
+
+@dataclass(frozen=True, slots=True)
 class DatabaseConfig:
     """Конфигурация базы данных"""
     url: str
-    min_connections: int = 2
-    max_connections: int = 10
+    min_connections: int = 4
+    max_connections: int = 32
     command_timeout: int = 60
     pool_timeout: int = 30
 
-@dataclass
+@dataclass(frozen=True, slots=True)
 class BotConfig:
     """Конфигурация бота"""
     token: str
@@ -19,7 +30,7 @@ class BotConfig:
     rate_limit_per_second: int = 30
     polling_timeout: int = 30
 
-@dataclass
+@dataclass(frozen=True, slots=True)
 class SecurityConfig:
     """Конфигурация безопасности"""
     activation_code_length: int = 8
@@ -27,7 +38,7 @@ class SecurityConfig:
     max_activation_codes_per_admin: int = 10
     max_chats_per_admin: int = 50
 
-@dataclass
+@dataclass(frozen=True, slots=True)
 class CacheConfig:
     """Конфигурация кэширования"""
     admin_cache_ttl: int = 300  # 5 минут
@@ -35,7 +46,7 @@ class CacheConfig:
     username_cache_size: int = 1000
     commands_cache_size: int = 100
 
-@dataclass
+@dataclass(frozen=True, slots=True)
 class LoggingConfig:
     """Конфигурация логирования"""
     level: str = "INFO"
@@ -43,44 +54,57 @@ class LoggingConfig:
     mask_sensitive_data: bool = True
 
 class Config:
-    """Основная конфигурация приложения"""
-    
-    def __init__(self):
-        self.database = DatabaseConfig(
+    """Основная конфигурация приложения
+
+    Секции читаются из окружения лениво и кэшируются — процесс платит
+    только за те подсистемы, которые реально использует.
+    """
+
+    @cached_property
+    def database(self) -> DatabaseConfig:
+        return DatabaseConfig(
             url=os.getenv("DATABASE_URL", ""),
-            min_connections=int(os.getenv("DB_MIN_CONNECTIONS", "2")),
-            max_connections=int(os.getenv("DB_MAX_CONNECTIONS", "10")),
-            command_timeout=int(os.getenv("DB_COMMAND_TIMEOUT", "60")),
-            pool_timeout=int(os.getenv("DB_POOL_TIMEOUT", "30"))
+            min_connections=_env_int("DB_MIN_CONNECTIONS", 4),
+            max_connections=_env_int("DB_MAX_CONNECTIONS", 32),
+            command_timeout=_env_int("DB_COMMAND_TIMEOUT", 60),
+            pool_timeout=_env_int("DB_POOL_TIMEOUT", 30)
         )
-        
-        self.bot = BotConfig(
+
+    @cached_property
+    def bot(self) -> BotConfig:
+        return BotConfig(
             token=os.getenv("BOT_TOKEN", ""),
             main_admin_id=int(os.getenv("MAIN_ADMIN_ID")) if os.getenv("MAIN_ADMIN_ID") else None,
-            rate_limit_per_second=int(os.getenv("BOT_RATE_LIMIT", "30")),
-            polling_timeout=int(os.getenv("BOT_POLLING_TIMEOUT", "30"))
+            rate_limit_per_second=_env_int("BOT_RATE_LIMIT", 30),
+            polling_timeout=_env_int("BOT_POLLING_TIMEOUT", 30)
         )
-        
-        self.security = SecurityConfig(
-            activation_code_length=int(os.getenv("ACTIVATION_CODE_LENGTH", "8")),
-            activation_code_expiry_hours=int(os.getenv("ACTIVATION_CODE_EXPIRY", "24")),
-            max_activation_codes_per_admin=int(os.getenv("MAX_ACTIVATION_CODES", "10")),
-            max_chats_per_admin=int(os.getenv("MAX_CHATS_PER_ADMIN", "50"))
+
+    @cached_property
+    def security(self) -> SecurityConfig:
+        return SecurityConfig(
+            activation_code_length=_env_int("ACTIVATION_CODE_LENGTH", 8),
+            activation_code_expiry_hours=_env_int("ACTIVATION_CODE_EXPIRY", 24),
+            max_activation_codes_per_admin=_env_int("MAX_ACTIVATION_CODES", 10),
+            max_chats_per_admin=_env_int("MAX_CHATS_PER_ADMIN", 50)
         )
-        
-        self.cache = CacheConfig(
-            admin_cache_ttl=int(os.getenv("ADMIN_CACHE_TTL", "300")),
-            rate_limit_window=float(os.getenv("RATE_LIMIT_WINDOW", "1.0")),
-            username_cache_size=int(os.getenv("USERNAME_CACHE_SIZE", "1000")),
-            commands_cache_size=int(os.getenv("COMMANDS_CACHE_SIZE", "100"))
+
+    @cached_property
+    def cache(self) -> CacheConfig:
+        return CacheConfig(
+            admin_cache_ttl=_env_int("ADMIN_CACHE_TTL", 300),
+            rate_limit_window=_env_float("RATE_LIMIT_WINDOW", 1.0),
+            username_cache_size=_env_int("USERNAME_CACHE_SIZE", 1000),
+            commands_cache_size=_env_int("COMMANDS_CACHE_SIZE", 100)
         )
-        
-        self.logging = LoggingConfig(
+
+    @cached_property
+    def logging(self) -> LoggingConfig:
+        return LoggingConfig(
             level=os.getenv("LOG_LEVEL", "INFO"),
             format=os.getenv("LOG_FORMAT", "%(asctime)s %(levelname)s %(name)s: %(message)s"),
             mask_sensitive_data=os.getenv("MASK_SENSITIVE_DATA", "true").lower() == "true"
         )
-    
+
     def validate(self) -> bool:
         """Валидация конфигурации"""
         if not self.database.url:
@@ -94,5 +118,11 @@ class Config:
         
         return True
 
-# Глобальный экземпляр конфигурации
-config = Config()
+@lru_cache(maxsize=1)
+def get_config() -> Config:
+    """Возвращает единственный экземпляр конфигурации"""
+    return Config()
+
+
+# Глобальный экземпляр конфигурации (секции читаются лениво)
+config = get_config()
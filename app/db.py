@@ -1,17 +1,263 @@
+import asyncio
 import os
 import asyncpg
-from datetime import datetime
+from collections import OrderedDict
 from typing import Optional, List, Tuple, Dict, Any
 import logging
-import hashlib
+import zlib
 import time
+from contextlib import asynccontextmanager
 from functools import lru_cache
 
+from app.config import config
+
+logger = logging.getLogger(__name__)
+
+# Версия схемы: поднимать при любом изменении _SCHEMA_SQL или набора
+# индексов, чтобы DDL-батч выполнился на существующих базах
+_SCHEMA_VERSION = 3
+
+# Вся схема — один идемпотентный скрипт: CREATE/ALTER ... IF NOT EXISTS
+# вместо introspection-запросов к information_schema, один round-trip
+# вместо ~десятка на каждый старт
+_SCHEMA_SQL = """
+CREATE TABLE IF NOT EXISTS users (
+    user_id BIGINT PRIMARY KEY,
+    username TEXT,
+    first_name TEXT,
+    last_name TEXT,
+    last_seen_ts BIGINT NOT NULL,
+    created_at BIGINT NOT NULL DEFAULT EXTRACT(EPOCH FROM NOW())
+);
+ALTER TABLE users ADD COLUMN IF NOT EXISTS created_at BIGINT NOT NULL DEFAULT EXTRACT(EPOCH FROM NOW());
+-- Нормализованный username поддерживается самой базой: probe-сторона
+-- сравнивает по обычному btree без вычисления lower() на каждую строку
+ALTER TABLE users ADD COLUMN IF NOT EXISTS username_lc TEXT GENERATED ALWAYS AS (lower(username)) STORED;
+
+CREATE TABLE IF NOT EXISTS pings (
+    id BIGINT GENERATED BY DEFAULT AS IDENTITY PRIMARY KEY,
+    chat_id BIGINT NOT NULL,
+    source_message_id BIGINT NOT NULL,
+    source_user_id BIGINT NOT NULL,
+    target_user_id BIGINT NOT NULL,
+    ping_reason TEXT NOT NULL,
+    ping_ts BIGINT NOT NULL,
+    close_ts BIGINT,
+    close_type TEXT,
+    close_message_id BIGINT,
+    reaction_emoji TEXT,
+    created_at BIGINT NOT NULL DEFAULT EXTRACT(EPOCH FROM NOW())
+);
+-- Переименование старой колонки closed_ts (если база создана старой версией)
+DO $$
+BEGIN
+    IF EXISTS (SELECT 1 FROM information_schema.columns
+               WHERE table_schema = 'public' AND table_name = 'pings' AND column_name = 'closed_ts')
+       AND NOT EXISTS (SELECT 1 FROM information_schema.columns
+               WHERE table_schema = 'public' AND table_name = 'pings' AND column_name = 'close_ts')
+    THEN
+        EXECUTE 'ALTER TABLE pings RENAME COLUMN closed_ts TO close_ts';
+    END IF;
+END $$;
+ALTER TABLE pings ADD COLUMN IF NOT EXISTS close_type TEXT;
+ALTER TABLE pings ADD COLUMN IF NOT EXISTS close_message_id BIGINT;
+ALTER TABLE pings ADD COLUMN IF NOT EXISTS reaction_emoji TEXT;
+ALTER TABLE pings ADD COLUMN IF NOT EXISTS created_at BIGINT NOT NULL DEFAULT EXTRACT(EPOCH FROM NOW());
+
+CREATE TABLE IF NOT EXISTS activation_codes (
+    id SERIAL PRIMARY KEY,
+    code TEXT UNIQUE NOT NULL,
+    expires_at BIGINT NOT NULL,
+    created_by BIGINT NOT NULL,
+    created_at BIGINT NOT NULL DEFAULT EXTRACT(EPOCH FROM NOW()),
+    used_at BIGINT,
+    used_by BIGINT
+);
+ALTER TABLE activation_codes ADD COLUMN IF NOT EXISTS used_at BIGINT;
+ALTER TABLE activation_codes ADD COLUMN IF NOT EXISTS used_by BIGINT;
+ALTER TABLE activation_codes ADD COLUMN IF NOT EXISTS created_at BIGINT NOT NULL DEFAULT EXTRACT(EPOCH FROM NOW());
+
+CREATE TABLE IF NOT EXISTS activated_chats (
+    id SERIAL PRIMARY KEY,
+    chat_id BIGINT UNIQUE NOT NULL,
+    chat_name TEXT NOT NULL,
+    activated_by BIGINT NOT NULL,
+    activated_at BIGINT NOT NULL DEFAULT EXTRACT(EPOCH FROM NOW()),
+    last_activity BIGINT DEFAULT EXTRACT(EPOCH FROM NOW())
+);
+ALTER TABLE activated_chats ADD COLUMN IF NOT EXISTS last_activity BIGINT DEFAULT EXTRACT(EPOCH FROM NOW());
+ALTER TABLE activated_chats DROP COLUMN IF EXISTS activation_code;
+
+-- Сводная таблица для топов: поддерживается при закрытии пингов,
+-- get_top читает её вместо агрегации по всей истории
+CREATE TABLE IF NOT EXISTS ping_stats (
+    chat_id BIGINT NOT NULL,
+    target_user_id BIGINT NOT NULL,
+    bucket_day BIGINT NOT NULL,
+    sum_resp BIGINT NOT NULL DEFAULT 0,
+    cnt BIGINT NOT NULL DEFAULT 0,
+    PRIMARY KEY(chat_id, target_user_id, bucket_day)
+);
+-- Первичное наполнение из уже закрытых пингов (только если сводка пуста)
+INSERT INTO ping_stats(chat_id, target_user_id, bucket_day, sum_resp, cnt)
+SELECT chat_id, target_user_id, close_ts / 86400,
+       SUM(close_ts - ping_ts), COUNT(*)
+FROM pings
+WHERE close_ts IS NOT NULL
+  AND NOT EXISTS (SELECT 1 FROM ping_stats)
+GROUP BY chat_id, target_user_id, close_ts / 86400;
+"""
+
+# SQL горячих путей выносим в константы модуля: asyncpg кэширует подготовленные
+# запросы по тексту SQL на каждом соединении, поэтому неизменная строка
+# гарантирует попадание в кэш (parse/plan выполняются один раз на соединение)
+_SQL_UPSERT_USER = """
+INSERT INTO users(user_id, username, first_name, last_name, last_seen_ts)
+VALUES($1, $2, $3, $4, $5)
+ON CONFLICT (user_id) DO UPDATE SET
+    username=EXCLUDED.username,
+    first_name=EXCLUDED.first_name,
+    last_name=EXCLUDED.last_name,
+    last_seen_ts=EXCLUDED.last_seen_ts
+"""
+
+# Уникальность "один открытый пинг на (chat, target)" обеспечивает частичный
+# индекс uniq_pings_open: вместо NOT EXISTS (гонка между снапшотом и вставкой
+# при конкурентных сообщениях) дубликат отсекает сам Postgres в той же вставке
+_SQL_RECORD_PING = """
+INSERT INTO pings(chat_id, source_message_id, source_user_id, target_user_id, ping_reason, ping_ts)
+VALUES($1, $2, $3, $4, $5, $6)
+ON CONFLICT (chat_id, target_user_id) WHERE close_ts IS NULL DO NOTHING
+RETURNING id
+"""
+
+# Все цели одного сообщения вставляются одним statement'ом через unnest:
+# K упоминаний -> один round-trip. ON CONFLICT, в отличие от NOT EXISTS,
+# корректно гасит и повтор одной цели внутри самой пачки
+_SQL_RECORD_PINGS = """
+INSERT INTO pings(chat_id, source_message_id, source_user_id, target_user_id, ping_reason, ping_ts)
+SELECT $1, $2, $3, t.uid, t.reason, $4
+FROM unnest($5::bigint[], $6::text[]) AS t(uid, reason)
+ON CONFLICT (chat_id, target_user_id) WHERE close_ts IS NULL DO NOTHING
+"""
+
+_SQL_CLOSE_OLDEST_BY_MESSAGE = """
+UPDATE pings SET close_ts=$3, close_type='message', close_message_id=$4
+WHERE id = (
+    SELECT id FROM pings
+    WHERE chat_id=$1 AND target_user_id=$2 AND close_ts IS NULL
+    ORDER BY ping_ts ASC
+    LIMIT 1
+    FOR UPDATE SKIP LOCKED
+)
+RETURNING id, ping_ts, close_ts
+"""
+
+# Два фиксированных варианта топа вместо f-строки с ORDER BY: текст запроса
+# не меняется между вызовами, поэтому план кэшируется для обоих направлений
+_SQL_GET_TOP = """
+SELECT target_user_id, SUM(cnt) as n,
+       SUM(sum_resp)::float / SUM(cnt) as avg_sec
+FROM ping_stats
+WHERE chat_id = $1
+GROUP BY target_user_id
+ORDER BY avg_sec {order}
+LIMIT $2
+"""
+_SQL_GET_TOP_ASC = _SQL_GET_TOP.format(order="ASC")
+_SQL_GET_TOP_DESC = _SQL_GET_TOP.format(order="DESC")
+
+_SQL_TOP_USERNAMES = """
+SELECT user_id, username, first_name FROM users WHERE user_id = ANY($1)
+"""
+
+# Единый текст запроса для статистики с опциональной нижней границей:
+# NULL в $3 отключает фильтр, не меняя текст (и кэшированный план) запроса
+# COUNT+SUM вместо AVG: среднее в Postgres считается в numeric и
+# декодируется asyncpg как Decimal; два bigint и деление в Python дешевле.
+# Два статичных варианта (с окном и без) — каждому свой кэшированный план,
+# и вариант с ping_ts >= $3 не таскает OR-ветку в предикате
+_SQL_USER_STATS_ALL = """
+SELECT COUNT(*)::bigint AS cnt, SUM(close_ts - ping_ts)::bigint AS total
+FROM pings
+WHERE chat_id=$1 AND target_user_id=$2 AND close_ts IS NOT NULL
+"""
+
+_SQL_USER_STATS_SINCE = _SQL_USER_STATS_ALL + "  AND ping_ts >= $3\n"
+
+# Запросы read-path'а тоже выносим в константы: резолв и проверка активации
+# выполняются на каждом сообщении, стабильный текст = стабильный кэш планов
+_SQL_RESOLVE_USERNAME = """
+SELECT user_id FROM users WHERE username_lc = $1 ORDER BY last_seen_ts DESC LIMIT 1
+"""
+
+# Батч-резолв упоминаний: DISTINCT ON отдаёт самый свежий user_id
+# на каждый username одним запросом вместо запроса на упоминание
+_SQL_RESOLVE_USERNAMES = """
+SELECT DISTINCT ON (username_lc) username_lc, user_id
+FROM users
+WHERE username_lc = ANY($1::text[])
+ORDER BY username_lc, last_seen_ts DESC
+"""
+
+_SQL_GET_USER_INFO = """
+SELECT username, first_name, last_name FROM users WHERE user_id = $1
+"""
+
+_SQL_GET_OPEN_PINGS = """
+SELECT target_user_id, ping_ts, source_message_id FROM pings
+WHERE chat_id=$1 AND close_ts IS NULL
+"""
+
+_SQL_GET_ACTIVATION_CODE = """
+SELECT code, expires_at, created_by, created_at
+FROM activation_codes
+WHERE code = $1 AND expires_at > $2 AND used_at IS NULL
+"""
+
+_SQL_CLOSE_BY_REACTION = """
+UPDATE pings SET close_ts=$4, close_type='reaction', reaction_emoji=$5
+WHERE id = (
+    SELECT id FROM pings
+    WHERE chat_id=$1 AND target_user_id=$2 AND source_message_id=$3 AND close_ts IS NULL
+    ORDER BY ping_ts ASC
+    LIMIT 1
+    FOR UPDATE SKIP LOCKED
+)
+RETURNING id, ping_ts, close_ts
+"""
+
+# Инкрементальное обновление сводной таблицы при закрытии пинга
+_SQL_BUMP_PING_STATS = """
+INSERT INTO ping_stats(chat_id, target_user_id, bucket_day, sum_resp, cnt)
+VALUES($1, $2, $3, $4, 1)
+ON CONFLICT (chat_id, target_user_id, bucket_day) DO UPDATE SET
+    sum_resp = ping_stats.sum_resp + EXCLUDED.sum_resp,
+    cnt = ping_stats.cnt + 1
+"""
+
 class Database:
     def __init__(self, dsn: Optional[str] = None):
         self._dsn = dsn or os.getenv("DATABASE_URL")
         self.pool: Optional[asyncpg.Pool] = None
-        self._prepared_statements: Dict[str, str] = {}
+        # LRU-кэш резолва username -> user_id (размер и TTL из конфигурации)
+        self._username_cache: "OrderedDict[str, Tuple[int, float]]" = OrderedDict()
+        # LRU-кэш карточек пользователей (get_user_info): имена меняются
+        # редко, а карточка нужна при каждом показе открытых пингов
+        self._user_info_cache: "OrderedDict[int, Tuple[dict, float]]" = OrderedDict()
+        # Множество активированных чатов в памяти процесса: таблица
+        # почти статична, бот — единственный писатель, поэтому набор
+        # загружается при старте и правится в activate/deactivate_chat
+        self._activated_chat_ids: set = set()
+        # Пары (chat_id, target_user_id) с открытым пингом: бот —
+        # единственный писатель в pings, поэтому набор в памяти позволяет
+        # пропускать UPDATE-закрытие для авторов без открытых пингов
+        self._open_pings: set = set()
+        # Очередь отложенной записи пользователей: один батч вместо
+        # отдельного UPSERT на каждое сообщение
+        self._user_queue: "asyncio.Queue[Tuple[int, Optional[str], Optional[str], Optional[str], int]]" = asyncio.Queue()
+        self._user_flush_task: Optional[asyncio.Task] = None
+        self._code_reap_task: Optional[asyncio.Task] = None
         
         if not self._dsn:
             raise RuntimeError("DATABASE_URL не установлен")
@@ -20,251 +266,168 @@ class Database:
         if not self._dsn.startswith(('postgresql://', 'postgres://')):
             raise RuntimeError("Неверный формат DATABASE_URL")
 
+    @asynccontextmanager
+    async def connection(self):
+        """Одно соединение на логическую операцию
+
+        Обработчик одного апдейта обычно делает несколько вызовов подряд
+        (резолв, запись пинга, закрытие) — под этим контекстом они идут
+        через один acquire вместо acquire на каждый вызов.
+        """
+        async with self.pool.acquire() as conn:
+            yield conn
+
+    @asynccontextmanager
+    async def _acquire(self, conn=None):
+        """Отдаёт переданное соединение или берёт новое из пула"""
+        if conn is not None:
+            yield conn
+        else:
+            async with self.pool.acquire() as c:
+                yield c
+
     async def initialize(self):
         """Инициализация базы данных с оптимизациями"""
         try:
-            logging.info("🔌 Подключение к базе данных...")
+            logger.info("🔌 Подключение к базе данных...")
             
-            # Оптимизированные настройки пула соединений
+            # Размеры пула берём из конфигурации (DB_MIN/MAX_CONNECTIONS)
             self.pool = await asyncpg.create_pool(
-                self._dsn, 
-                min_size=2,  # Увеличиваем минимальный размер пула
-                max_size=10,  # Увеличиваем максимальный размер пула
-                command_timeout=60,  # Увеличиваем таймаут
+                self._dsn,
+                min_size=config.database.min_connections,
+                max_size=config.database.max_connections,
+                command_timeout=config.database.command_timeout,
+                max_queries=50000,  # Периодический рецикл соединений (обновляет кэш планов)
+                max_inactive_connection_lifetime=300.0,
+                statement_cache_size=1024,  # Кэш подготовленных запросов на соединение
                 server_settings={
                     'application_name': 'pingmeter_bot',
                     'jit': 'off',  # Отключаем JIT для простых запросов
                     'random_page_cost': '1.1',  # Оптимизация для SSD
-                    'effective_cache_size': '256MB'  # Размер кэша
+                    'effective_cache_size': '256MB',  # Размер кэша
+                    # Метрики пингов переживут потерю пары последних секунд
+                    # при падении сервера; без fsync на каждый COMMIT
+                    # запись перестаёт упираться в диск
+                    'synchronous_commit': 'off'
                 }
             )
             
-            logging.info("✅ Подключение к базе данных установлено")
+            logger.info("✅ Подключение к базе данных установлено")
             
-            # Создаем таблицы и индексы
-            await self._create_tables()
-            await self._create_indexes()
-            await self._prepare_statements()
+            # Создаем таблицы и индексы на одном соединении —
+            # без повторных acquire/release между этапами. DDL гоняем
+            # только при смене версии схемы: на обычном старте вся
+            # миграционная часть сводится к одному SELECT version
+            async with self.pool.acquire() as conn:
+                version = None
+                try:
+                    version = await conn.fetchval("SELECT version FROM schema_version WHERE id = 1")
+                except asyncpg.UndefinedTableError:
+                    pass
+
+                if version != _SCHEMA_VERSION:
+                    await self._create_tables(conn)
+                    await self._create_indexes(conn)
+                    await conn.execute("""
+                        CREATE TABLE IF NOT EXISTS schema_version (
+                            id INT PRIMARY KEY DEFAULT 1 CHECK (id = 1),
+                            version INT NOT NULL
+                        );
+                    """)
+                    await conn.execute(
+                        """
+                        INSERT INTO schema_version(id, version) VALUES (1, $1)
+                        ON CONFLICT (id) DO UPDATE SET version = EXCLUDED.version
+                        """,
+                        _SCHEMA_VERSION
+                    )
+
+                # Загружаем множество активированных чатов
+                rows = await conn.fetch("SELECT chat_id FROM activated_chats")
+                self._activated_chat_ids = {r[0] for r in rows}
+
+                # И пары с открытыми пингами — см. has_open_ping
+                rows = await conn.fetch(
+                    "SELECT chat_id, target_user_id FROM pings WHERE close_ts IS NULL"
+                )
+                self._open_pings = {(r[0], r[1]) for r in rows}
+
+            # Фоновая запись очереди пользователей батчами
+            self._user_flush_task = asyncio.create_task(self._flush_users_loop())
+            # Периодическая чистка просроченных кодов активации
+            self._code_reap_task = asyncio.create_task(self._reap_codes_loop())
             
         except Exception as e:
-            logging.error(f"❌ Ошибка подключения к базе данных: {e}")
+            logger.error(f"❌ Ошибка подключения к базе данных: {e}")
             raise
 
-    async def _create_tables(self):
-        """Создание таблиц с оптимизированной структурой"""
-        async with self.pool.acquire() as conn:
-            # Проверяем существующие таблицы
-            existing_tables = await conn.fetch("""
-                SELECT table_name FROM information_schema.tables 
-                WHERE table_schema = 'public' AND table_name IN ('users', 'pings', 'activation_codes', 'activated_chats')
-            """)
-            existing_table_names = [row['table_name'] for row in existing_tables]
-            
-            # Создаём таблицы если их нет
-            if 'users' not in existing_table_names:
-                await conn.execute("""
-                CREATE TABLE users (
-                    user_id BIGINT PRIMARY KEY,
-                    username TEXT,
-                    first_name TEXT,
-                    last_name TEXT,
-                    last_seen_ts BIGINT NOT NULL,
-                    created_at BIGINT NOT NULL DEFAULT EXTRACT(EPOCH FROM NOW())
-                );
-                """)
-            else:
-                # Миграция существующей таблицы users
-                await self._migrate_users_table(conn)
-            
-            if 'pings' not in existing_table_names:
-                await conn.execute("""
-                CREATE TABLE pings (
-                    id SERIAL PRIMARY KEY,
-                    chat_id BIGINT NOT NULL,
-                    source_message_id BIGINT NOT NULL,
-                    source_user_id BIGINT NOT NULL,
-                    target_user_id BIGINT NOT NULL,
-                    ping_reason TEXT NOT NULL,
-                    ping_ts BIGINT NOT NULL,
-                    close_ts BIGINT,
-                    close_type TEXT,
-                    close_message_id BIGINT,
-                    reaction_emoji TEXT,
-                    created_at BIGINT NOT NULL DEFAULT EXTRACT(EPOCH FROM NOW())
-                );
-                """)
-            else:
-                # Миграция существующей таблицы pings
-                await self._migrate_pings_table(conn)
-            
-            if 'activation_codes' not in existing_table_names:
-                await conn.execute("""
-                CREATE TABLE activation_codes (
-                    id SERIAL PRIMARY KEY,
-                    code TEXT UNIQUE NOT NULL,
-                    expires_at BIGINT NOT NULL,
-                    created_by BIGINT NOT NULL,
-                    created_at BIGINT NOT NULL DEFAULT EXTRACT(EPOCH FROM NOW()),
-                    used_at BIGINT,
-                    used_by BIGINT
-                );
-                """)
-            else:
-                # Миграция существующей таблицы activation_codes
-                await self._migrate_activation_codes_table(conn)
-            
-            if 'activated_chats' not in existing_table_names:
-                await conn.execute("""
-                CREATE TABLE activated_chats (
-                    id SERIAL PRIMARY KEY,
-                    chat_id BIGINT UNIQUE NOT NULL,
-                    chat_name TEXT NOT NULL,
-                    activated_by BIGINT NOT NULL,
-                    activated_at BIGINT NOT NULL DEFAULT EXTRACT(EPOCH FROM NOW()),
-                    last_activity BIGINT DEFAULT EXTRACT(EPOCH FROM NOW())
-                );
-                """)
-            else:
-                # Миграция существующей таблицы activated_chats
-                await self._migrate_activated_chats_table(conn)
-
-    async def _create_indexes(self):
-        """Создание оптимизированных индексов"""
-        async with self.pool.acquire() as conn:
-            # Индексы для таблицы users
-            await conn.execute("""
-                CREATE INDEX IF NOT EXISTS idx_users_username ON users(username) WHERE username IS NOT NULL;
-                CREATE INDEX IF NOT EXISTS idx_users_last_seen ON users(last_seen_ts DESC);
-            """)
-            
-            # Индексы для таблицы pings
-            await conn.execute("""
-                CREATE INDEX IF NOT EXISTS idx_pings_chat_target ON pings(chat_id, target_user_id);
-                CREATE INDEX IF NOT EXISTS idx_pings_target_open ON pings(target_user_id) WHERE close_ts IS NULL;
-                CREATE INDEX IF NOT EXISTS idx_pings_chat_open ON pings(chat_id) WHERE close_ts IS NULL;
-                CREATE INDEX IF NOT EXISTS idx_pings_ping_ts ON pings(ping_ts DESC);
-                CREATE INDEX IF NOT EXISTS idx_pings_close_ts ON pings(close_ts DESC) WHERE close_ts IS NOT NULL;
-                CREATE INDEX IF NOT EXISTS idx_pings_chat_ping_ts ON pings(chat_id, ping_ts DESC);
-            """)
-            
-            # Индексы для таблицы activation_codes
-            await conn.execute("""
-                CREATE INDEX IF NOT EXISTS idx_activation_codes_expires ON activation_codes(expires_at);
-                CREATE INDEX IF NOT EXISTS idx_activation_codes_used ON activation_codes(used_at) WHERE used_at IS NOT NULL;
-            """)
-            
-            # Индексы для таблицы activated_chats
-            await conn.execute("""
-                CREATE INDEX IF NOT EXISTS idx_activated_chats_last_activity ON activated_chats(last_activity DESC);
-            """)
+    async def _create_tables(self, conn):
+        """Создание и миграция таблиц одним идемпотентным скриптом"""
+        await conn.execute(_SCHEMA_SQL)
 
-    async def _prepare_statements(self):
-        """Подготовка часто используемых запросов"""
-        async with self.pool.acquire() as conn:
-            # Подготавливаем часто используемые запросы
-            self._prepared_statements = {
-                'get_user': await conn.prepare("""
-                    SELECT user_id, username, first_name, last_name, last_seen_ts 
-                    FROM users WHERE user_id = $1
-                """),
-                'get_user_by_username': await conn.prepare("""
-                    SELECT user_id FROM users WHERE lower(username) = lower($1) 
-                    ORDER BY last_seen_ts DESC LIMIT 1
-                """),
-                'get_open_pings': await conn.prepare("""
-                    SELECT target_user_id, ping_ts, source_message_id 
-                    FROM pings 
-                    WHERE chat_id = $1 AND close_ts IS NULL 
-                    ORDER BY ping_ts ASC
-                """),
-                'is_chat_activated': await conn.prepare("""
-                    SELECT chat_id FROM activated_chats WHERE chat_id = $1
-                """),
-                'get_activation_code': await conn.prepare("""
-                    SELECT code, expires_at, created_by, created_at 
-                    FROM activation_codes 
-                    WHERE code = $1 AND expires_at > $2 AND used_at IS NULL
-                """)
-            }
+    async def _create_indexes(self, conn):
+        """Создание оптимизированных индексов
 
-    async def _migrate_pings_table(self, conn):
-        """Миграция таблицы pings"""
-        columns = await conn.fetch("""
-            SELECT column_name FROM information_schema.columns 
-            WHERE table_name = 'pings' AND table_schema = 'public'
-        """)
-        column_names = [row['column_name'] for row in columns]
-        
-        # Если есть старая колонка closed_ts, переименовываем её
-        if 'closed_ts' in column_names and 'close_ts' not in column_names:
-            await conn.execute("ALTER TABLE pings RENAME COLUMN closed_ts TO close_ts;")
-        
-        # Добавляем недостающие колонки если их нет
-        if 'close_type' not in column_names:
-            await conn.execute("ALTER TABLE pings ADD COLUMN close_type TEXT;")
-        if 'close_message_id' not in column_names:
-            await conn.execute("ALTER TABLE pings ADD COLUMN close_message_id BIGINT;")
-        if 'reaction_emoji' not in column_names:
-            await conn.execute("ALTER TABLE pings ADD COLUMN reaction_emoji TEXT;")
-        if 'created_at' not in column_names:
-            await conn.execute("ALTER TABLE pings ADD COLUMN created_at BIGINT NOT NULL DEFAULT EXTRACT(EPOCH FROM NOW());")
-
-    async def _migrate_activation_codes_table(self, conn):
-        """Миграция таблицы activation_codes"""
-        columns = await conn.fetch("""
-            SELECT column_name FROM information_schema.columns 
-            WHERE table_name = 'activation_codes' AND table_schema = 'public'
-        """)
-        column_names = [row['column_name'] for row in columns]
-        
-        # Добавляем недостающие колонки если их нет
-        if 'used_at' not in column_names:
-            await conn.execute("ALTER TABLE activation_codes ADD COLUMN used_at BIGINT;")
-        if 'used_by' not in column_names:
-            await conn.execute("ALTER TABLE activation_codes ADD COLUMN used_by BIGINT;")
-        if 'created_at' not in column_names:
-            await conn.execute("ALTER TABLE activation_codes ADD COLUMN created_at BIGINT NOT NULL DEFAULT EXTRACT(EPOCH FROM NOW());")
-
-    async def _migrate_activated_chats_table(self, conn):
-        """Миграция таблицы activated_chats"""
-        columns = await conn.fetch("""
-            SELECT column_name FROM information_schema.columns 
-            WHERE table_name = 'activated_chats' AND table_schema = 'public'
-        """)
-        column_names = [row['column_name'] for row in columns]
-        
-        # Добавляем недостающие колонки если их нет
-        if 'last_activity' not in column_names:
-            await conn.execute("ALTER TABLE activated_chats ADD COLUMN last_activity BIGINT DEFAULT EXTRACT(EPOCH FROM NOW());")
-        
-        # Если есть старая колонка activation_code, удаляем её
-        if 'activation_code' in column_names:
-            await conn.execute("ALTER TABLE activated_chats DROP COLUMN activation_code;")
-
-    async def _migrate_users_table(self, conn):
-        """Миграция таблицы users"""
-        columns = await conn.fetch("""
-            SELECT column_name FROM information_schema.columns 
-            WHERE table_name = 'users' AND table_schema = 'public'
-        """)
-        column_names = [row['column_name'] for row in columns]
-        
-        # Добавляем недостающие колонки если их нет
-        if 'created_at' not in column_names:
-            await conn.execute("ALTER TABLE users ADD COLUMN created_at BIGINT NOT NULL DEFAULT EXTRACT(EPOCH FROM NOW());")
+        На уже наполненной базе индексы строятся CONCURRENTLY, чтобы не
+        блокировать запись на время построения; на пустой/маленькой
+        обычный CREATE INDEX быстрее. CONCURRENTLY нельзя выполнять в
+        транзакции и пачке, поэтому statements идут по одному.
+        """
+        reltuples = await conn.fetchval(
+            "SELECT COALESCE((SELECT reltuples FROM pg_class WHERE relname = 'pings'), 0)"
+        )
+        cic = "CONCURRENTLY " if reltuples and reltuples > 100000 else ""
+
+        for stmt in (
+            # users
+            "DROP INDEX IF EXISTS idx_users_username",
+            "CREATE INDEX {cic}IF NOT EXISTS idx_users_temp_username ON users(username) WHERE user_id < 0",
+            "DROP INDEX IF EXISTS idx_users_lower_username",
+            "CREATE INDEX {cic}IF NOT EXISTS idx_users_username_lc ON users(username_lc, last_seen_ts DESC)",
+            "CREATE INDEX {cic}IF NOT EXISTS idx_users_last_seen ON users(last_seen_ts DESC)",
+            # pings
+            "CREATE INDEX {cic}IF NOT EXISTS idx_pings_chat_target ON pings(chat_id, target_user_id)",
+            # На исторических данных могли накопиться дубликаты открытых
+            # пингов — перед уникальным индексом оставляем самый старый
+            """DELETE FROM pings p USING pings d
+               WHERE p.close_ts IS NULL AND d.close_ts IS NULL
+                 AND p.chat_id = d.chat_id AND p.target_user_id = d.target_user_id
+                 AND p.id > d.id""",
+            # Арбитр для ON CONFLICT в record_ping/record_pings
+            "CREATE UNIQUE INDEX {cic}IF NOT EXISTS uniq_pings_open ON pings(chat_id, target_user_id) WHERE close_ts IS NULL",
+            "DROP INDEX IF EXISTS idx_pings_target_open",
+            "DROP INDEX IF EXISTS idx_pings_chat_open",
+            # INCLUDE покрывает все колонки get_open_pings — index-only scan
+            "DROP INDEX IF EXISTS idx_pings_open_lookup",
+            "CREATE INDEX {cic}IF NOT EXISTS idx_pings_open_lookup ON pings(chat_id, target_user_id, ping_ts) INCLUDE (source_message_id) WHERE close_ts IS NULL",
+            "CREATE INDEX {cic}IF NOT EXISTS idx_pings_open_msg ON pings(chat_id, source_message_id) WHERE close_ts IS NULL",
+            "CREATE INDEX {cic}IF NOT EXISTS idx_pings_ping_ts ON pings(ping_ts DESC)",
+            "CREATE INDEX {cic}IF NOT EXISTS idx_pings_close_ts ON pings(close_ts DESC) WHERE close_ts IS NOT NULL",
+            "CREATE INDEX {cic}IF NOT EXISTS idx_pings_chat_ping_ts ON pings(chat_id, ping_ts DESC)",
+            # activation_codes
+            "CREATE INDEX {cic}IF NOT EXISTS idx_activation_codes_expires ON activation_codes(expires_at)",
+            "CREATE INDEX {cic}IF NOT EXISTS idx_activation_codes_used ON activation_codes(used_at) WHERE used_at IS NOT NULL",
+            # activated_chats
+            "CREATE INDEX {cic}IF NOT EXISTS idx_activated_chats_last_activity ON activated_chats(last_activity DESC)",
+        ):
+            await conn.execute(stmt.format(cic=cic))
 
     @lru_cache(maxsize=1000)
     def _hash_username(self, username: str) -> int:
-        """Хеширование username для временных пользователей"""
-        return int(hashlib.md5(username.encode()).hexdigest()[:8], 16) % (2**31)
+        """Хеширование username для временных пользователей
 
-    async def create_temp_user_by_username(self, username: str) -> int:
+        CRC32 вместо MD5: криптостойкость здесь не нужна, а crc32 для
+        коротких строк на порядок дешевле и без hex-преобразований.
+        """
+        return zlib.crc32(username.encode('utf-8')) & 0x7FFFFFFF
+
+    async def create_temp_user_by_username(self, username: str, conn: Optional[asyncpg.Connection] = None) -> int:
         """Создает временного пользователя по username для пингов"""
         now = int(time.time())
         # Генерируем временный user_id (отрицательный, чтобы не конфликтовать с реальными)
         temp_user_id = -self._hash_username(username)
         
-        async with self.pool.acquire() as conn:
+        async with self._acquire(conn) as conn:
             await conn.execute(
                 """
                 INSERT INTO users(user_id, username, first_name, last_name, last_seen_ts)
@@ -281,106 +444,326 @@ class Database:
 
 
 
-    async def upsert_user(self, user_id: int, username: Optional[str], first_name: Optional[str], last_name: Optional[str]):
-        now = int(datetime.utcnow().timestamp())
-        async with self.pool.acquire() as conn:
+    async def upsert_user(self, user_id: int, username: Optional[str], first_name: Optional[str], last_name: Optional[str], conn: Optional[asyncpg.Connection] = None):
+        now = int(time.time())
+        async with self._acquire(conn) as conn:
             await conn.execute(
-                """
-                INSERT INTO users(user_id, username, first_name, last_name, last_seen_ts)
-                VALUES($1, $2, $3, $4, $5)
-                ON CONFLICT (user_id) DO UPDATE SET
-                    username=EXCLUDED.username,
-                    first_name=EXCLUDED.first_name,
-                    last_name=EXCLUDED.last_name,
-                    last_seen_ts=EXCLUDED.last_seen_ts
-                """,
+                _SQL_UPSERT_USER,
                 user_id, username, first_name, last_name, now
             )
+        self._username_cache_invalidate(username)
+        self._user_info_cache_invalidate(user_id)
 
-    async def record_ping(self, chat_id: int, source_message_id: int, source_user_id: int, target_user_id: int, ping_reason: str, ping_ts: int):
+    async def upsert_users_bulk(self, records: List[Tuple[int, Optional[str], Optional[str], Optional[str], int]]):
+        """Записывает пачку пользователей одной транзакцией
+
+        Args:
+            records: Кортежи (user_id, username, first_name, last_name,
+                     last_seen_ts), дедуплицированные по user_id
+        """
+        if not records:
+            return
         async with self.pool.acquire() as conn:
-            print(f"📝 Создаём пинг: chat_id={chat_id}, target_user_id={target_user_id}, reason={ping_reason}")
-            # Проверяем, есть ли уже открытый пинг для этого пользователя в этом чате
-            row = await conn.fetchrow(
-                """
-                SELECT id FROM pings
-                WHERE chat_id=$1 AND target_user_id=$2 AND close_ts IS NULL
-                LIMIT 1
-                """,
-                chat_id, target_user_id
-            )
-            if row:
-                print(f"⚠️ Уже есть открытый пинг для target_user_id={target_user_id}, не создаём новый")
-                return  # Уже есть открытый пинг, не создаём новый
-            print(f"✅ Создаём новый пинг для target_user_id={target_user_id}")
-            await conn.execute(
-                """
-                INSERT INTO pings(chat_id, source_message_id, source_user_id, target_user_id, ping_reason, ping_ts)
-                VALUES($1, $2, $3, $4, $5, $6)
-                """,
+            async with conn.transaction():
+                if len(records) > 1000:
+                    # Для больших импортов COPY во временную таблицу на порядок
+                    # быстрее executemany; затем один upsert из staging
+                    await conn.execute("""
+                        CREATE TEMP TABLE _users_stage
+                        (LIKE users INCLUDING DEFAULTS) ON COMMIT DROP
+                    """)
+                    await conn.copy_records_to_table(
+                        '_users_stage',
+                        records=records,
+                        columns=['user_id', 'username', 'first_name', 'last_name', 'last_seen_ts']
+                    )
+                    await conn.execute("""
+                        INSERT INTO users(user_id, username, first_name, last_name, last_seen_ts)
+                        SELECT user_id, username, first_name, last_name, last_seen_ts
+                        FROM _users_stage
+                        ON CONFLICT (user_id) DO UPDATE SET
+                            username=EXCLUDED.username,
+                            first_name=EXCLUDED.first_name,
+                            last_name=EXCLUDED.last_name,
+                            last_seen_ts=EXCLUDED.last_seen_ts
+                    """)
+                else:
+                    await conn.executemany(_SQL_UPSERT_USER, records)
+        for record in records:
+            self._username_cache_invalidate(record[1])
+            self._user_info_cache_invalidate(record[0])
+
+    def queue_user_upsert(self, user_id: int, username: Optional[str], first_name: Optional[str], last_name: Optional[str]):
+        """Ставит апсерт пользователя в очередь отложенной записи
+
+        Вызывается на каждом сообщении: вместо немедленного round-trip'а
+        запись попадёт в ближайший батч фоновой задачи.
+        """
+        self._user_queue.put_nowait((user_id, username, first_name, last_name, int(time.time())))
+
+    async def _flush_users_loop(self, max_batch: int = 200, flush_interval: float = 0.5):
+        """Фоновая задача: сливает очередь пользователей батчами
+
+        Ждёт первую запись, затем добирает очередь в пределах окна
+        flush_interval / лимита max_batch, дедуплицирует по user_id
+        (остаётся самая свежая) и пишет одной транзакцией.
+        """
+        while True:
+            try:
+                record = await self._user_queue.get()
+                batch = {record[0]: record}
+                deadline = time.monotonic() + flush_interval
+                while len(batch) < max_batch:
+                    timeout = deadline - time.monotonic()
+                    if timeout <= 0:
+                        break
+                    try:
+                        record = await asyncio.wait_for(self._user_queue.get(), timeout)
+                    except asyncio.TimeoutError:
+                        break
+                    batch[record[0]] = record
+                await self.upsert_users_bulk(list(batch.values()))
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error("❌ Ошибка фоновой записи пользователей: %s", e)
+
+    async def _reap_codes_loop(self, interval: float = 3600.0):
+        """Фоновая задача: раз в час удаляет просроченные коды активации
+
+        get_activation_code фильтрует expires_at > now, но без чистки
+        просроченные строки копятся вечно; удаление держит таблицу
+        маленькой (поиск по уникальному code остаётся точечным).
+        """
+        while True:
+            try:
+                await asyncio.sleep(interval)
+                async with self.pool.acquire() as conn:
+                    await conn.execute(
+                        "DELETE FROM activation_codes WHERE expires_at <= $1",
+                        int(time.time())
+                    )
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error("❌ Ошибка чистки кодов активации: %s", e)
+
+    async def _drain_user_queue(self):
+        """Дописывает остаток очереди (вызывается при остановке)"""
+        batch: Dict[int, Tuple] = {}
+        while not self._user_queue.empty():
+            record = self._user_queue.get_nowait()
+            batch[record[0]] = record
+        if batch:
+            await self.upsert_users_bulk(list(batch.values()))
+
+    async def record_ping(self, chat_id: int, source_message_id: int, source_user_id: int, target_user_id: int, ping_reason: str, ping_ts: int, conn: Optional[asyncpg.Connection] = None) -> Optional[int]:
+        """Создаёт пинг, если у пользователя нет открытого в этом чате
+
+        Проверка и вставка объединены в один INSERT ... WHERE NOT EXISTS:
+        один round-trip вместо SELECT + INSERT и нет гонки между ними.
+        Возвращает id созданного пинга или None, если открытый уже есть.
+        """
+        async with self._acquire(conn) as conn:
+            ping_id = await conn.fetchval(
+                _SQL_RECORD_PING,
                 chat_id, source_message_id, source_user_id, target_user_id, ping_reason, ping_ts
             )
+        # Пара открыта в обоих исходах: либо вставили, либо конфликт с уже открытым
+        self._open_pings.add((chat_id, target_user_id))
+        return ping_id
 
-    async def close_oldest_open_ping_by_message(self, chat_id: int, target_user_id: int, close_message_id: int, close_ts: int) -> Optional[int]:
-        async with self.pool.acquire() as conn:
-            print(f"🔍 Ищем открытый пинг для закрытия: chat_id={chat_id}, target_user_id={target_user_id}")
-            row = await conn.fetchrow(
-                """
-                SELECT id FROM pings
-                WHERE chat_id=$1 AND target_user_id=$2 AND close_ts IS NULL
-                ORDER BY ping_ts ASC
-                LIMIT 1
-                """,
-                chat_id, target_user_id
-            )
-            if not row:
-                print(f"❌ Не найден открытый пинг для закрытия: chat_id={chat_id}, target_user_id={target_user_id}")
-                return None
-            ping_id = row["id"]
-            print(f"✅ Закрываем пинг: ping_id={ping_id}, close_ts={close_ts}, close_message_id={close_message_id}")
+    async def record_pings(self, chat_id: int, source_message_id: int, source_user_id: int, targets: List[Tuple[int, str]], ping_ts: int, conn: Optional[asyncpg.Connection] = None):
+        """Записывает все пинги одного сообщения одним запросом
+
+        Args:
+            targets: Кортежи (target_user_id, ping_reason)
+        """
+        if not targets:
+            return
+        uids = [t[0] for t in targets]
+        reasons = [t[1] for t in targets]
+        async with self._acquire(conn) as conn:
             await conn.execute(
-                """
-                UPDATE pings SET close_ts=$1, close_type='message', close_message_id=$2 WHERE id=$3
-                """,
-                close_ts, close_message_id, ping_id
+                _SQL_RECORD_PINGS,
+                chat_id, source_message_id, source_user_id, ping_ts, uids, reasons
             )
-            return ping_id
+        self._open_pings.update((chat_id, uid) for uid in uids)
+
+    async def record_pings_bulk(self, rows: List[Tuple[int, int, int, int, str, int]]):
+        """Записывает пачку пингов одной транзакцией
+
+        Args:
+            rows: Кортежи (chat_id, source_message_id, source_user_id,
+                  target_user_id, ping_reason, ping_ts)
+        """
+        if not rows:
+            return
+        async with self.pool.acquire() as conn:
+            async with conn.transaction():
+                if len(rows) > 1000:
+                    # Для бэкфилов COPY во временную таблицу на порядок
+                    # быстрее executemany; затем один INSERT с той же
+                    # защитой от дубликатов открытых пингов
+                    # Только шесть копируемых колонок: LIKE pings утащил бы
+                    # NOT NULL с id без его IDENTITY-default, и COPY падал бы
+                    await conn.execute("""
+                        CREATE TEMP TABLE _pings_stage (
+                            chat_id BIGINT,
+                            source_message_id BIGINT,
+                            source_user_id BIGINT,
+                            target_user_id BIGINT,
+                            ping_reason TEXT,
+                            ping_ts BIGINT
+                        ) ON COMMIT DROP
+                    """)
+                    await conn.copy_records_to_table(
+                        '_pings_stage',
+                        records=rows,
+                        columns=['chat_id', 'source_message_id', 'source_user_id',
+                                 'target_user_id', 'ping_reason', 'ping_ts']
+                    )
+                    await conn.execute("""
+                        INSERT INTO pings(chat_id, source_message_id, source_user_id,
+                                          target_user_id, ping_reason, ping_ts)
+                        SELECT s.chat_id, s.source_message_id, s.source_user_id,
+                               s.target_user_id, s.ping_reason, s.ping_ts
+                        FROM _pings_stage s
+                        ON CONFLICT (chat_id, target_user_id)
+                            WHERE close_ts IS NULL DO NOTHING
+                    """)
+                else:
+                    await conn.executemany(_SQL_RECORD_PING, rows)
+        self._open_pings.update((r[0], r[3]) for r in rows)
+
+    async def close_oldest_open_ping_by_message(self, chat_id: int, target_user_id: int, close_message_id: int, close_ts: int, conn: Optional[asyncpg.Connection] = None) -> Optional[int]:
+        async with self._acquire(conn) as conn:
+            async with conn.transaction():
+                # SELECT и UPDATE объединены в один запрос — один round-trip вместо двух
+                row = await conn.fetchrow(
+                    _SQL_CLOSE_OLDEST_BY_MESSAGE,
+                    chat_id, target_user_id, close_ts, close_message_id
+                )
+                # Открытый пинг на пару только один (uniq_pings_open), так что
+                # после этого запроса открытых у пары нет в обоих исходах
+                self._open_pings.discard((chat_id, target_user_id))
+                if row is None:
+                    return None
+                # Обновляем сводную статистику в той же транзакции
+                await conn.execute(
+                    _SQL_BUMP_PING_STATS,
+                    chat_id, target_user_id, row["close_ts"] // 86400,
+                    row["close_ts"] - row["ping_ts"]
+                )
+                return row["id"]
 
+    async def close_ping_by_reaction(self, chat_id: int, target_user_id: int, reacted_message_id: int, close_ts: int, reaction_emoji: Optional[str], conn: Optional[asyncpg.Connection] = None) -> Optional[int]:
+        """Закрывает пинг реакцией на сообщение-пинг"""
+        async with self._acquire(conn) as conn:
+            async with conn.transaction():
+                row = await conn.fetchrow(
+                    _SQL_CLOSE_BY_REACTION,
+                    chat_id, target_user_id, reacted_message_id, close_ts, reaction_emoji
+                )
+                if row is None:
+                    return None
+                # Обновляем сводную статистику в той же транзакции
+                await conn.execute(
+                    _SQL_BUMP_PING_STATS,
+                    chat_id, target_user_id, row["close_ts"] // 86400,
+                    row["close_ts"] - row["ping_ts"]
+                )
+                self._open_pings.discard((chat_id, target_user_id))
+                return row["id"]
 
+    def _username_cache_get(self, key: str) -> Optional[int]:
+        """Возвращает user_id из кэша или None (учитывая TTL)"""
+        entry = self._username_cache.get(key)
+        if entry is None:
+            return None
+        user_id, cached_at = entry
+        if time.monotonic() - cached_at > config.cache.admin_cache_ttl:
+            del self._username_cache[key]
+            return None
+        self._username_cache.move_to_end(key)
+        return user_id
 
+    def _username_cache_put(self, key: str, user_id: int):
+        """Сохраняет резолв в кэш, вытесняя самые старые записи"""
+        self._username_cache[key] = (user_id, time.monotonic())
+        self._username_cache.move_to_end(key)
+        while len(self._username_cache) > config.cache.username_cache_size:
+            self._username_cache.popitem(last=False)
 
+    def _username_cache_invalidate(self, username: Optional[str]):
+        """Сбрасывает кэшированный резолв при обновлении пользователя"""
+        if username:
+            self._username_cache.pop(username.lower(), None)
 
-    async def resolve_username(self, username: str) -> Optional[int]:
-        async with self.pool.acquire() as conn:
-            print(f"🔍 Ищем username='{username}' в базе данных")
-            row = await conn.fetchrow(
-                """
-                SELECT user_id FROM users WHERE lower(username)=lower($1) ORDER BY last_seen_ts DESC LIMIT 1
-                """,
-                username
-            )
-            result = row["user_id"] if row else None
-            print(f"📋 Результат поиска username='{username}': user_id={result}")
+    async def resolve_username(self, username: str, conn: Optional[asyncpg.Connection] = None) -> Optional[int]:
+        key = username.lower()
+        cached = self._username_cache_get(key)
+        if cached is not None:
+            return cached
+
+        async with self._acquire(conn) as conn:
+            row = await conn.fetchrow(_SQL_RESOLVE_USERNAME, key)
+            result = row[0] if row else None
+            logger.debug("Резолв username=%s -> user_id=%s", username, result)
+            if result is not None:
+                self._username_cache_put(key, result)
             return result
 
+    def _user_info_cache_invalidate(self, user_id: int):
+        """Сбрасывает кэшированную карточку при обновлении пользователя"""
+        self._user_info_cache.pop(user_id, None)
+
+    async def resolve_usernames(self, usernames: List[str], conn: Optional[asyncpg.Connection] = None) -> Dict[str, int]:
+        """Резолвит пачку username'ов одним запросом
+
+        Возвращает {username_lower: user_id}. Кэш тот же, что у
+        resolve_username — в базу уходят только промахи, найденное
+        кэшируется для следующих сообщений.
+        """
+        result: Dict[str, int] = {}
+        misses: List[str] = []
+        for name in usernames:
+            key = name.lower()
+            cached = self._username_cache_get(key)
+            if cached is not None:
+                result[key] = cached
+            elif key not in misses:
+                misses.append(key)
+        if misses:
+            async with self._acquire(conn) as conn:
+                rows = await conn.fetch(_SQL_RESOLVE_USERNAMES, misses)
+            for key, user_id in rows:
+                result[key] = user_id
+                self._username_cache_put(key, user_id)
+        return result
+
     async def get_user_info(self, user_id: int):
-        """Получить информацию о пользователе"""
-        async with self.pool.acquire() as conn:
-            row = await conn.fetchrow(
-                """
-                SELECT username, first_name, last_name
-                FROM users
-                WHERE user_id = $1
-                """,
-                user_id
-            )
-            if row:
-                return {
-                    'username': row['username'],
-                    'first_name': row['first_name'],
-                    'last_name': row['last_name']
-                }
-            return None
+        """Получить информацию о пользователе (с LRU-кэшем в памяти)"""
+        entry = self._user_info_cache.get(user_id)
+        if entry is not None:
+            info, cached_at = entry
+            if time.monotonic() - cached_at <= config.cache.admin_cache_ttl:
+                self._user_info_cache.move_to_end(user_id)
+                return info
+            del self._user_info_cache[user_id]
+
+        row = await self.pool.fetchrow(_SQL_GET_USER_INFO, user_id)
+        info = None
+        if row:
+            info = {
+                'username': row[0],
+                'first_name': row[1],
+                'last_name': row[2]
+            }
+            self._user_info_cache[user_id] = (info, time.monotonic())
+            while len(self._user_info_cache) > config.cache.username_cache_size:
+                self._user_info_cache.popitem(last=False)
+        return info
 
     async def get_top(self, chat_id: int, limit: int = 10, order: str = "ASC"):
         """Получить топ пользователей по времени ответа
@@ -391,174 +774,157 @@ class Database:
             order: "ASC" для быстрых (по возрастанию), "DESC" для медленных (по убыванию)
         """
         async with self.pool.acquire() as conn:
-            rows = await conn.fetch(
-                f"""
-                SELECT 
-                    p.target_user_id,
-                    COUNT(*) as n,
-                    AVG(p.close_ts - p.ping_ts) as avg_sec,
-                    u.username
-                FROM pings p
-                LEFT JOIN users u ON p.target_user_id = u.user_id
-                WHERE p.chat_id = $1 
-                AND p.close_ts IS NOT NULL
-                GROUP BY p.target_user_id, u.username
-                HAVING COUNT(*) >= 1
-                ORDER BY avg_sec {order}
-                LIMIT $2
-                """,
-                chat_id, limit
-            )
+            # Читаем сводную таблицу вместо агрегации по всей истории пингов;
+            # имена подтягиваем отдельным запросом только для топ-K строк
+            sql = _SQL_GET_TOP_ASC if order.upper() == "ASC" else _SQL_GET_TOP_DESC
+            rows = await conn.fetch(sql, chat_id, limit)
+            if not rows:
+                return []
+
+            # Позиционный доступ к Record — без хэширования имён колонок
+            # на каждую строку
+            user_ids = [row[0] for row in rows]
+            users = await conn.fetch(_SQL_TOP_USERNAMES, user_ids)
+            names = {u[0]: u[1] or u[2] for u in users}
+
             result = []
-            for row in rows:
-                user_id = row['target_user_id']
-                username = row['username']
-                
-                # Если нет username, получаем first_name
-                if not username:
-                    user_info = await self.get_user_info(user_id)
-                    if user_info and user_info.get('first_name'):
-                        username = user_info.get('first_name')
-                    else:
-                        username = f'user_{user_id}'
-                
-                result.append((user_id, row['n'], row['avg_sec'], username))
-            
+            for user_id, n, avg_sec in rows:
+                username = names.get(user_id) or f'user_{user_id}'
+                result.append((user_id, n, avg_sec, username))
+
             return result
 
     async def get_user_stats(self, chat_id: int, user_id: int, since_ts: Optional[int]) -> Optional[Tuple[int, float]]:
-        params: List = [chat_id, user_id]
-        where = "close_ts IS NOT NULL"
-        if since_ts is not None:
-            where += " AND ping_ts >= $3"
-            params.append(since_ts)
-        query = f"""
-        SELECT COUNT(*) as cnt, AVG(close_ts - ping_ts) AS avg_response
-        FROM pings
-        WHERE chat_id=$1 AND target_user_id=$2 AND {where}
+        if since_ts is None:
+            row = await self.pool.fetchrow(_SQL_USER_STATS_ALL, chat_id, user_id)
+        else:
+            row = await self.pool.fetchrow(_SQL_USER_STATS_SINCE, chat_id, user_id, since_ts)
+        if row and row[0] > 0:
+            cnt, total = row[0], row[1]
+            return (cnt, total / cnt if total is not None else None)
+        return None
+
+    async def iter_open_pings(self, chat_id: int):
+        """Стримит открытые пинги чата серверным курсором
+
+        Не материализует весь результат в памяти — вызывающий может
+        выйти из цикла раньше, и лишние строки не будут прочитаны.
         """
         async with self.pool.acquire() as conn:
-            row = await conn.fetchrow(query, *params)
-            if row and row[0] > 0:
-                return (int(row[0]), float(row[1]) if row[1] is not None else None)
-            return None
+            async with conn.transaction():
+                async for r in conn.cursor(_SQL_GET_OPEN_PINGS, chat_id):
+                    yield (r[0], r[1], r[2])
 
     async def get_open_pings(self, chat_id: int) -> List[Tuple[int, int, int]]:
-        async with self.pool.acquire() as conn:
-            rows = await conn.fetch(
-                """
-                SELECT target_user_id, ping_ts, source_message_id FROM pings
-                WHERE chat_id=$1 AND close_ts IS NULL
-                """,
-                chat_id
-            )
-            return [(r[0], r[1], r[2] if r[2] is not None else None) for r in rows]
+        """Список открытых пингов (обёртка над iter_open_pings)"""
+        return [p async for p in self.iter_open_pings(chat_id)]
 
 
 
     async def save_activation_code(self, code: str, expires_at: int, created_by: int):
         """Сохраняет код активации"""
-        now = int(datetime.utcnow().timestamp())
-        async with self.pool.acquire() as conn:
-            await conn.execute(
-                """
-                INSERT INTO activation_codes(code, expires_at, created_by, created_at)
-                VALUES($1, $2, $3, $4)
-                """,
-                code, expires_at, created_by, now
-            )
+        now = int(time.time())
+        await self.pool.execute(
+            """
+            INSERT INTO activation_codes(code, expires_at, created_by, created_at)
+            VALUES($1, $2, $3, $4)
+            """,
+            code, expires_at, created_by, now
+        )
 
     async def get_activation_code(self, code: str):
         """Получает информацию о коде активации"""
-        async with self.pool.acquire() as conn:
-            row = await conn.fetchrow(
-                """
-                SELECT code, expires_at, created_by, created_at
-                FROM activation_codes
-                WHERE code = $1 AND expires_at > $2 AND used_at IS NULL
-                """,
-                code, int(datetime.utcnow().timestamp())
-            )
-            if row:
-                return {
-                    'code': row['code'],
-                    'expires_at': row['expires_at'],
-                    'created_by': row['created_by'],
-                    'created_at': row['created_at']
-                }
-            return None
+        row = await self.pool.fetchrow(_SQL_GET_ACTIVATION_CODE, code, int(time.time()))
+        if row:
+            return {
+                'code': row[0],
+                'expires_at': row[1],
+                'created_by': row[2],
+                'created_at': row[3]
+            }
+        return None
 
     async def delete_activation_code(self, code: str):
         """Удаляет использованный код активации"""
-        async with self.pool.acquire() as conn:
-            await conn.execute(
-                """
-                DELETE FROM activation_codes
-                WHERE code = $1
-                """,
-                code
-            )
+        await self.pool.execute(
+            """
+            DELETE FROM activation_codes
+            WHERE code = $1
+            """,
+            code
+        )
 
     async def activate_chat(self, chat_id: int, chat_name: str, activation_code: str, activated_by: int):
-        """Активирует чат"""
-        now = int(datetime.utcnow().timestamp())
-        async with self.pool.acquire() as conn:
-            # Активируем чат
-            await conn.execute(
-                """
-                INSERT INTO activated_chats(chat_id, chat_name, activated_by, activated_at)
-                VALUES($1, $2, $3, $4)
-                ON CONFLICT (chat_id) DO UPDATE SET
-                    chat_name = EXCLUDED.chat_name,
-                    activated_by = EXCLUDED.activated_by,
-                    activated_at = EXCLUDED.activated_at
-                """,
-                chat_id, chat_name, activated_by, now
-            )
-            
-            # Отмечаем код как использованный
-            await conn.execute(
-                """
-                UPDATE activation_codes 
-                SET used_at = $1, used_by = $2 
-                WHERE code = $3
-                """,
-                now, activated_by, activation_code
+        """Активирует чат
+
+        Пометка кода использованным и upsert чата объединены в один
+        statement через CTE: один round-trip, и обе записи атомарны
+        без явной транзакции.
+        """
+        now = int(time.time())
+        await self.pool.execute(
+            """
+            WITH used AS (
+                UPDATE activation_codes
+                SET used_at = $4, used_by = $3
+                WHERE code = $5
             )
+            INSERT INTO activated_chats(chat_id, chat_name, activated_by, activated_at)
+            VALUES($1, $2, $3, $4)
+            ON CONFLICT (chat_id) DO UPDATE SET
+                chat_name = EXCLUDED.chat_name,
+                activated_by = EXCLUDED.activated_by,
+                activated_at = EXCLUDED.activated_at
+            """,
+            chat_id, chat_name, activated_by, now, activation_code
+        )
+        self._activated_chat_ids.add(chat_id)
 
     async def is_chat_activated(self, chat_id: int) -> bool:
-        """Проверяет, активирован ли чат"""
-        async with self.pool.acquire() as conn:
-            row = await conn.fetchrow(
-                """
-                SELECT chat_id FROM activated_chats
-                WHERE chat_id = $1
-                """,
-                chat_id
-            )
-            return row is not None
+        """Проверяет, активирован ли чат (по множеству в памяти)"""
+        return chat_id in self._activated_chat_ids
+
+    def has_open_ping(self, chat_id: int, user_id: int) -> bool:
+        """Есть ли у пользователя открытый пинг в этом чате
+
+        Ответ из памяти процесса: набор засеивается при старте и
+        поддерживается методами записи/закрытия пингов. Позволяет не
+        ходить в базу на каждом сообщении авторов без открытых пингов.
+        """
+        return (chat_id, user_id) in self._open_pings
+
+    def reset_caches(self):
+        """Сбрасывает всё состояние процесса, производное от таблиц
+
+        Нужен админским командам полной очистки базы: после DELETE по
+        таблицам наборы активированных чатов/открытых пингов и кэши
+        пользователей перестают отражать её содержимое.
+        """
+        self._activated_chat_ids.clear()
+        self._open_pings.clear()
+        self._username_cache.clear()
+        self._user_info_cache.clear()
 
     async def get_activated_chats(self):
         """Получает список всех активированных чатов"""
-        async with self.pool.acquire() as conn:
-            rows = await conn.fetch(
-                """
-                SELECT chat_id, chat_name, activated_by, activated_at
-                FROM activated_chats
-                ORDER BY activated_at DESC
-                """
-            )
-            return [(row['chat_id'], row['chat_name'], row['activated_by'], row['activated_at']) for row in rows]
+        rows = await self.pool.fetch(
+            """
+            SELECT chat_id, chat_name, activated_by, activated_at
+            FROM activated_chats
+            ORDER BY activated_at DESC
+            """
+        )
+        return [(r[0], r[1], r[2], r[3]) for r in rows]
 
     async def deactivate_chat(self, chat_id: int) -> bool:
         """Деактивирует чат и очищает все связанные данные"""
         async with self.pool.acquire() as conn:
             # Проверяем, существует ли чат
-            chat_exists = await conn.fetchrow(
-                "SELECT chat_id FROM activated_chats WHERE chat_id = $1",
+            chat_exists = await conn.fetchval(
+                "SELECT 1 FROM activated_chats WHERE chat_id = $1",
                 chat_id
             )
-            
+
             if not chat_exists:
                 return False
             
@@ -569,52 +935,70 @@ class Database:
                     "DELETE FROM pings WHERE chat_id = $1",
                     chat_id
                 )
-                print(f"🗑️ Удалено пингов для чата {chat_id}: {pings_deleted}")
-                
-                # 2. Находим пользователей, которые участвовали только в этом чате
-                users_to_delete = await conn.fetch(
-                    """
-                    SELECT DISTINCT u.user_id 
-                    FROM users u
-                    LEFT JOIN pings p ON u.user_id = p.source_user_id OR u.user_id = p.target_user_id
-                    WHERE u.user_id IN (
-                        SELECT DISTINCT source_user_id FROM pings WHERE chat_id = $1
-                        UNION
-                        SELECT DISTINCT target_user_id FROM pings WHERE chat_id = $1
-                    )
-                    AND p.id IS NULL
-                    """,
+                logger.debug("🗑️ Удалено пингов для чата %s: %s", chat_id, pings_deleted)
+
+                # Удаляем сводную статистику чата
+                await conn.execute(
+                    "DELETE FROM ping_stats WHERE chat_id = $1",
                     chat_id
                 )
                 
-                # 3. Удаляем пользователей, которые больше не участвуют ни в каких пингах
-                if users_to_delete:
-                    user_ids = [row['user_id'] for row in users_to_delete]
-                    users_deleted = await conn.execute(
-                        "DELETE FROM users WHERE user_id = ANY($1)",
-                        user_ids
-                    )
-                    print(f"🗑️ Удалено пользователей для чата {chat_id}: {users_deleted}")
+                # 2. Удаляем осиротевших временных пользователей одним
+                # statement'ом — без перевозки списка id через Python.
+                # Реальные учётки (user_id > 0) не трогаем: они могут
+                # состоять в других чатах без пингов.
+                users_deleted = await conn.execute(
+                    """
+                    DELETE FROM users u
+                    WHERE u.user_id < 0
+                      AND NOT EXISTS (
+                          SELECT 1 FROM pings p
+                          WHERE p.source_user_id = u.user_id OR p.target_user_id = u.user_id
+                      )
+                    """
+                )
+                logger.debug("🗑️ Удалено пользователей для чата %s: %s", chat_id, users_deleted)
                 
-                # 4. Удаляем запись об активации чата
-                result = await conn.execute(
-                    "DELETE FROM activated_chats WHERE chat_id = $1",
+                # 4. Удаляем запись об активации чата; количество строк
+                # получаем через RETURNING вместо разбора командного тега
+                deleted = await conn.fetchval(
+                    """
+                    WITH d AS (DELETE FROM activated_chats WHERE chat_id = $1 RETURNING 1)
+                    SELECT count(*) FROM d
+                    """,
                     chat_id
                 )
-                
-                print(f"✅ Чат {chat_id} деактивирован и все данные очищены")
-                return result != "DELETE 0"
+
+                logger.info("✅ Чат %s деактивирован и все данные очищены", chat_id)
+                self._activated_chat_ids.discard(chat_id)
+                self._open_pings = {p for p in self._open_pings if p[0] != chat_id}
+                return deleted > 0
 
     async def close(self):
+        if self._code_reap_task is not None:
+            self._code_reap_task.cancel()
+            try:
+                await self._code_reap_task
+            except asyncio.CancelledError:
+                pass
+            self._code_reap_task = None
+        if self._user_flush_task is not None:
+            self._user_flush_task.cancel()
+            try:
+                await self._user_flush_task
+            except asyncio.CancelledError:
+                pass
+            self._user_flush_task = None
         if self.pool is not None:
+            await self._drain_user_queue()
             await self.pool.close()
 
 
 
-    async def update_temp_user(self, username: str, real_user_id: int, first_name: str = None, last_name: str = None):
+    async def update_temp_user(self, username: str, real_user_id: int, first_name: str = None, last_name: str = None, conn: Optional[asyncpg.Connection] = None):
         """Обновляет временного пользователя реальными данными"""
-        now = int(datetime.utcnow().timestamp())
-        async with self.pool.acquire() as conn:
+        now = int(time.time())
+        async with self._acquire(conn) as conn:
             # Находим временного пользователя по username
             temp_user = await conn.fetchrow(
                 "SELECT user_id FROM users WHERE username = $1 AND user_id < 0",
@@ -632,16 +1016,52 @@ class Database:
                     real_user_id, first_name, last_name, now, temp_user['user_id']
                 )
                 
-                # Обновляем все пинги с временным user_id на реальный
-                await conn.execute(
-                    """
-                    UPDATE pings 
-                    SET target_user_id = $1 
-                    WHERE target_user_id = $2
-                    """,
-                    real_user_id, temp_user['user_id']
-                )
+                # Переносим пинги с временного user_id на реальный.
+                # Открытые переносим аккуратно: если у реального пользователя
+                # в том же чате уже есть свой открытый пинг (его пинганули и
+                # по @username, и по text_mention), слепой UPDATE нарушил бы
+                # uniq_pings_open — такой дубликат просто удаляем
+                async with conn.transaction():
+                    moved = await conn.fetch(
+                        """
+                        UPDATE pings p
+                        SET target_user_id = $1
+                        WHERE p.target_user_id = $2 AND p.close_ts IS NULL
+                          AND NOT EXISTS (
+                              SELECT 1 FROM pings r
+                              WHERE r.chat_id = p.chat_id
+                                AND r.target_user_id = $1
+                                AND r.close_ts IS NULL
+                          )
+                        RETURNING chat_id
+                        """,
+                        real_user_id, temp_user['user_id']
+                    )
+                    dropped = await conn.fetch(
+                        """
+                        DELETE FROM pings
+                        WHERE target_user_id = $1 AND close_ts IS NULL
+                        RETURNING chat_id
+                        """,
+                        temp_user['user_id']
+                    )
+                    # Закрытые пинги конфликтовать не могут — переносим все
+                    await conn.execute(
+                        "UPDATE pings SET target_user_id = $1 WHERE target_user_id = $2",
+                        real_user_id, temp_user['user_id']
+                    )
+                # Открытые пинги переехали на новый user_id — переносим
+                # и пары в наборе, иначе has_open_ping навсегда потеряет
+                # их из виду и закрытие перестанет вызываться
+                for r in moved:
+                    self._open_pings.discard((r['chat_id'], temp_user['user_id']))
+                    self._open_pings.add((r['chat_id'], real_user_id))
+                for r in dropped:
+                    self._open_pings.discard((r['chat_id'], temp_user['user_id']))
                 
-                logging.info(f"Обновлен временный пользователь @{username}: {temp_user['user_id']} -> {real_user_id}")
+                logger.info("Обновлен временный пользователь @%s: %s -> %s", username, temp_user['user_id'], real_user_id)
+                self._username_cache_invalidate(username)
+                self._user_info_cache_invalidate(temp_user['user_id'])
+                self._user_info_cache_invalidate(real_user_id)
 
 
@@ -9,7 +9,7 @@ from typing import Optional, Dict, Set
 from functools import lru_cache
 
 from aiogram import Router, F
-from aiogram.types import Message, CallbackQuery, InlineKeyboardMarkup, InlineKeyboardButton
+from aiogram.types import Message, CallbackQuery, InlineKeyboardMarkup, InlineKeyboardButton, MessageReactionUpdated
 from aiogram.filters import Command
 from aiogram.fsm.context import FSMContext
 from aiogram.fsm.state import State, StatesGroup
@@ -683,6 +683,7 @@ async def cmd_clear_db(message: Message) -> None:
         async with db.pool.acquire() as conn:
             # Удаляем ВСЕ данные
             await conn.execute("DELETE FROM pings")
+            await conn.execute("DELETE FROM ping_stats")
             await conn.execute("DELETE FROM users")
             await conn.execute("DELETE FROM activation_codes")
             await conn.execute("DELETE FROM activated_chats")
@@ -692,6 +693,9 @@ async def cmd_clear_db(message: Message) -> None:
             await conn.execute("ALTER SEQUENCE IF EXISTS activation_codes_id_seq RESTART WITH 1")
             await conn.execute("ALTER SEQUENCE IF EXISTS activated_chats_id_seq RESTART WITH 1")
         
+        # Состояние в памяти процесса должно забыть стёртые таблицы
+        db.reset_caches()
+        
         await message.reply("✅ База данных полностью очищена! Все данные удалены.")
     except Exception as e:
         await message.reply(f"❌ Ошибка при очистке: {e}")
@@ -712,6 +716,7 @@ async def cmd_reset_db(message: Message) -> None:
         async with db.pool.acquire() as conn:
             # Удаляем ВСЕ данные
             await conn.execute("DELETE FROM pings")
+            await conn.execute("DELETE FROM ping_stats")
             await conn.execute("DELETE FROM users")
             await conn.execute("DELETE FROM activation_codes")
             await conn.execute("DELETE FROM activated_chats")
@@ -721,6 +726,9 @@ async def cmd_reset_db(message: Message) -> None:
             await conn.execute("ALTER SEQUENCE IF EXISTS activation_codes_id_seq RESTART WITH 1")
             await conn.execute("ALTER SEQUENCE IF EXISTS activated_chats_id_seq RESTART WITH 1")
         
+        # Состояние в памяти процесса должно забыть стёртые таблицы
+        db.reset_caches()
+        
         await message.reply("✅ База данных полностью очищена! Все данные удалены.")
     except Exception as e:
         await message.reply(f"❌ Ошибка при очистке: {e}")
@@ -1188,19 +1196,15 @@ async def on_message(message: Message) -> None:
     
     bot_id = getattr(bot, "bot_id", None)
 
-    # Регистрируем пользователя
-    if message.from_user and not message.from_user.is_bot and (not bot_id or message.from_user.id != bot_id):
-        # Проверяем, есть ли временный пользователь с таким username
-        if message.from_user.username:
-            await db.update_temp_user(
-                message.from_user.username,
-                message.from_user.id,
-                message.from_user.first_name,
-                message.from_user.last_name
-            )
-        
-        # Обычная регистрация/обновление
-        await db.upsert_user(
+    author_is_human = bool(
+        message.from_user and not message.from_user.is_bot
+        and (not bot_id or message.from_user.id != bot_id)
+    )
+
+    # Регистрация/обновление — через очередь отложенной записи, фоновая
+    # задача сольёт её батчем без round-trip'а на каждое сообщение
+    if author_is_human:
+        db.queue_user_upsert(
             user_id=message.from_user.id,
             username=message.from_user.username,
             first_name=message.from_user.first_name,
@@ -1210,70 +1214,74 @@ async def on_message(message: Message) -> None:
     # Обрабатываем пинги
     entities = message.entities or []
     text = message.text or message.caption or ""
-    
-    logging.info(f"Обрабатываем сообщение: entities={len(entities)}, text='{text[:50]}...'")
-    
+    # Время сообщения считаем один раз: оно нужно и записи, и закрытию пингов
+    message_ts = int(message.date.timestamp())
+
+    # Один проход по entities: text_mention даёт user_id сразу, а все
+    # @username собираются и резолвятся одним батч-запросом вместо
+    # отдельного запроса на каждое упоминание
+    targets: list[tuple[int, str]] = []
+    mention_names: list[str] = []
     for ent in entities:
-        logging.info(f"Проверяем entity: type={ent.type}, user={ent.user.id if ent.user else None}")
-        logging.info(f"Проверяем условия: ent.type='{ent.type}', ent.user={ent.user}, bot_id={bot_id}")
-        # Проверяем условия для создания пинга
-        is_text_mention = ent.type == "text_mention" and ent.user and not ent.user.is_bot
-        is_mention = ent.type == "mention"
-        is_not_bot = not bot_id or (ent.user and ent.user.id != bot_id) if ent.user else True
-        
-        logging.info(f"Условия: is_text_mention={is_text_mention}, is_mention={is_mention}, is_not_bot={is_not_bot}")
-        
-        if (is_text_mention or is_mention) and is_not_bot:
-            logging.info(f"✅ Условия выполнены, обрабатываем entity типа '{ent.type}'")
-            target_user_id = None
-            
-            if ent.type == "text_mention" and ent.user:
-                target_user_id = ent.user.id
-                logging.info(f"text_mention: target_user_id={target_user_id}")
-            elif ent.type == "mention":
-                mention_text = text[ent.offset : ent.offset + ent.length]
-                username = mention_text.lstrip("@")
-                logging.info(f"Ищем пользователя: mention_text='{mention_text}', username='{username}'")
-                
-                # Ищем в базе данных
-                target_user_id = await db.resolve_username(username)
-                logging.info(f"Поиск в БД: username='{username}', resolved user_id={target_user_id}")
-                
+        if ent.type == "text_mention" and ent.user and not ent.user.is_bot and (not bot_id or ent.user.id != bot_id):
+            targets.append((ent.user.id, "text_mention"))
+        elif ent.type == "mention":
+            mention_names.append(text[ent.offset : ent.offset + ent.length].lstrip("@"))
+
+    # Вся работа с БД по этому сообщению идёт на одном соединении из пула:
+    # одно acquire вместо отдельного на каждый вызов
+    async with db.connection() as conn:
+        # Проверяем, есть ли временный пользователь с таким username
+        if author_is_human and message.from_user.username:
+            await db.update_temp_user(
+                message.from_user.username,
+                message.from_user.id,
+                message.from_user.first_name,
+                message.from_user.last_name,
+                conn=conn,
+            )
+
+        if mention_names:
+            resolved = await db.resolve_usernames(mention_names, conn=conn)
+            for username in mention_names:
+                target_user_id = resolved.get(username.lower())
                 # Если не нашли, создаем временного пользователя
                 if not target_user_id:
-                    logging.info(f"Создаем временного пользователя для @{username}")
-                    target_user_id = await db.create_temp_user_by_username(username)
-                    logging.info(f"Создан временный пользователь: username='{username}', temp_user_id={target_user_id}")
-            
-            if target_user_id and target_user_id != message.from_user.id:
-                logging.info(f"Создаём пинг: {ent.type} для user_id={target_user_id}")
-                await db.record_ping(
+                    target_user_id = await db.create_temp_user_by_username(username, conn=conn)
+                targets.append((target_user_id, "mention"))
+
+        # Все цели сообщения пишутся одним запросом
+        if message.from_user:
+            ping_targets = [
+                (target_user_id, ping_reason)
+                for target_user_id, ping_reason in targets
+                if target_user_id and target_user_id != message.from_user.id
+            ]
+            if ping_targets:
+                await db.record_pings(
                     chat_id=message.chat.id,
                     source_message_id=message.message_id,
                     source_user_id=message.from_user.id,
-                    target_user_id=target_user_id,
-                    ping_reason=ent.type,
-                    ping_ts=int(message.date.timestamp()),
+                    targets=ping_targets,
+                    ping_ts=message_ts,
+                    conn=conn,
                 )
+
+        # Закрываем самый старый открытый пинг для этого автора; проверка
+        # по набору в памяти избавляет от UPDATE, когда закрывать нечего
+        if author_is_human and db.has_open_ping(message.chat.id, message.from_user.id):
+            logging.info(f"🔍 Пытаемся закрыть пинг для пользователя {message.from_user.id} (username: {message.from_user.username})")
+            result = await db.close_oldest_open_ping_by_message(
+                chat_id=message.chat.id,
+                target_user_id=message.from_user.id,
+                close_message_id=message.message_id,
+                close_ts=message_ts,
+                conn=conn,
+            )
+            if result:
+                logging.info(f"✅ Пинг закрыт: ping_id={result}")
             else:
-                logging.info(f"Пропускаем пинг: target_user_id={target_user_id}, from_user.id={message.from_user.id}")
-        else:
-            logging.info(f"❌ Условия НЕ выполнены для entity типа '{ent.type}'")
-            continue
-    
-    # Закрываем самый старый открытый пинг для этого автора
-    if message.from_user and not message.from_user.is_bot and (not bot_id or message.from_user.id != bot_id):
-        logging.info(f"🔍 Пытаемся закрыть пинг для пользователя {message.from_user.id} (username: {message.from_user.username})")
-        result = await db.close_oldest_open_ping_by_message(
-            chat_id=message.chat.id,
-            target_user_id=message.from_user.id,
-            close_message_id=message.message_id,
-            close_ts=int(message.date.timestamp()),
-        )
-        if result:
-            logging.info(f"✅ Пинг закрыт: ping_id={result}")
-        else:
-            logging.info(f"❌ Не найден открытый пинг для закрытия")
+                logging.info(f"❌ Не найден открытый пинг для закрытия")
 
 @router.message(F.reply_to_message)
 async def on_reply(message: Message) -> None:
@@ -1288,8 +1296,9 @@ async def on_reply(message: Message) -> None:
     
     bot_id = getattr(bot, "bot_id", None)
     
-    # Закрываем самый старый открытый пинг для этого автора
-    if message.from_user and not message.from_user.is_bot and (not bot_id or message.from_user.id != bot_id):
+    # Закрываем самый старый открытый пинг для этого автора (если он есть)
+    if message.from_user and not message.from_user.is_bot and (not bot_id or message.from_user.id != bot_id) \
+            and db.has_open_ping(message.chat.id, message.from_user.id):
         logging.info(f"🔍 [REPLY] Пытаемся закрыть пинг для пользователя {message.from_user.id} (username: {message.from_user.username})")
         result = await db.close_oldest_open_ping_by_message(
             chat_id=message.chat.id,
@@ -1303,6 +1312,46 @@ async def on_reply(message: Message) -> None:
             logging.info(f"❌ [REPLY] Не найден открытый пинг для закрытия")
 
 
+@router.message_reaction()
+async def on_reaction(message_reaction: MessageReactionUpdated) -> None:
+    """Обработчик реакций: закрывает пинг реакцией на сообщение-пинг"""
+    bot = message_reaction.bot
+    db: Database = getattr(bot, "db")
+
+    is_activated = await db.is_chat_activated(message_reaction.chat.id)
+    if not is_activated:
+        return  # Игнорируем реакции в неактивированных чатах
+
+    user = message_reaction.user
+    bot_id = getattr(bot, "bot_id", None)
+    if not user or user.is_bot or (bot_id and user.id == bot_id):
+        return
+
+    # Закрываем пинг только при добавлении реакции (не при снятии)
+    if not message_reaction.new_reaction:
+        return
+
+    emoji = None
+    for reaction in message_reaction.new_reaction:
+        if getattr(reaction, "emoji", None):
+            emoji = reaction.emoji
+            break
+
+    # Без открытого пинга у автора реакции закрывать нечего
+    if not db.has_open_ping(message_reaction.chat.id, user.id):
+        return
+
+    result = await db.close_ping_by_reaction(
+        chat_id=message_reaction.chat.id,
+        target_user_id=user.id,
+        reacted_message_id=message_reaction.message_id,
+        close_ts=int(message_reaction.date.timestamp()),
+        reaction_emoji=emoji,
+    )
+    if result:
+        logging.info(f"✅ [REACTION] Пинг закрыт: ping_id={result}")
+
+
 
 
 
@@ -11,6 +11,7 @@ from aiogram.client.bot import DefaultBotProperties
 from aiogram.enums import ParseMode
 from aiogram.exceptions import TelegramBadRequest, TelegramConflictError
 
+from app.config import get_config
 from app.handlers import router
 from app.db import Database
 
@@ -74,24 +75,14 @@ async def run() -> None:
         log_level = os.getenv("LOG_LEVEL", "INFO")
         setup_logging(log_level)
         
-        # Валидируем токен
-        token = os.getenv("BOT_TOKEN")
-        if not token:
-            raise RuntimeError("BOT_TOKEN не установлен в переменных окружения")
-        
+        # Валидируем конфигурацию один раз при старте
+        config = get_config()
+        config.validate()
+
+        token = config.bot.token
         if not validate_bot_token(token):
             raise RuntimeError("Неверный формат BOT_TOKEN")
-        
-        # Валидируем DATABASE_URL
-        database_url = os.getenv("DATABASE_URL")
-        if not database_url:
-            raise RuntimeError("DATABASE_URL не установлен в переменных окружения")
-        
-        # Проверяем MAIN_ADMIN_ID
-        main_admin_id = os.getenv("MAIN_ADMIN_ID")
-        if not main_admin_id or not main_admin_id.isdigit():
-            logging.warning("MAIN_ADMIN_ID не установлен или неверный формат")
-        
+
         logging.info("🚀 Запуск бота...")
         
         # Создаем экземпляр базы данных
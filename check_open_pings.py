@@ -0,0 +1,105 @@
+"""Диагностический скрипт: показывает открытые и недавно закрытые пинги по всем чатам.
+
+Вместо отдельных запросов на каждый chat_id (N*3 round-trip'ов) выполняется
+один запрос с оконной функцией, а группировка по чатам делается в Python.
+"""
+import asyncio
+import os
+from datetime import datetime
+
+import asyncpg
+from dotenv import load_dotenv
+
+# Один запрос вместо цикла по чатам: ROW_NUMBER() по (chat_id, открыт/закрыт)
+# отдаёт до 10 последних пингов каждой категории для каждого чата.
+PINGS_OVERVIEW_SQL = """
+SELECT chat_id, target_user_id, ping_ts, close_ts, source_message_id, ping_reason
+FROM (
+    SELECT chat_id, target_user_id, ping_ts, close_ts, source_message_id, ping_reason,
+           ROW_NUMBER() OVER (
+               PARTITION BY chat_id, (close_ts IS NULL)
+               ORDER BY ping_ts DESC
+           ) AS rn
+    FROM pings
+) t
+WHERE rn <= 10
+ORDER BY chat_id, ping_ts DESC
+"""
+
+
+def format_ts(ts):
+    """Форматирует unix timestamp в читаемый вид"""
+    if ts is None:
+        return "—"
+    return datetime.fromtimestamp(ts).strftime('%d.%m.%Y %H:%M:%S')
+
+
+async def check_open_pings():
+    """Выводит сводку по пингам, сгруппированную по чатам"""
+    load_dotenv()
+
+    dsn = os.getenv("DATABASE_URL")
+    if not dsn:
+        raise RuntimeError("DATABASE_URL не установлен")
+
+    def flush_chat(chat_id, open_pings, closed_pings):
+        """Печатает накопленную сводку одного чата"""
+        print(f"\n💬 Чат {chat_id}:")
+
+        if open_pings:
+            print(f"  ⏰ Открытые пинги ({len(open_pings)}):")
+            for r in open_pings:
+                print(f"    • user_{r['target_user_id']} с {format_ts(r['ping_ts'])} "
+                      f"(msg {r['source_message_id']}, {r['ping_reason']})")
+        else:
+            print("  ✅ Нет открытых пингов")
+
+        if closed_pings:
+            print(f"  📊 Последние закрытые ({len(closed_pings)}):")
+            for r in closed_pings:
+                elapsed = r['close_ts'] - r['ping_ts']
+                print(f"    • user_{r['target_user_id']}: {format_ts(r['ping_ts'])} → "
+                      f"{format_ts(r['close_ts'])} ({elapsed}с)")
+
+    # Отдельное read-only подключение: диагностика не занимает пул бота
+    # и физически не может помешать его записям
+    conn = await asyncpg.connect(
+        dsn,
+        server_settings={
+            'application_name': 'pingmeter_diag',
+            'default_transaction_read_only': 'on',
+        },
+    )
+    try:
+        # Стримим результат серверным курсором: строки упорядочены по chat_id,
+        # поэтому сводку каждого чата можно печатать по мере прихода данных,
+        # не собирая весь результат в память
+        seen_any = False
+        current_chat = None
+        open_pings: list = []
+        closed_pings: list = []
+
+        async with conn.transaction():
+            async for r in conn.cursor(PINGS_OVERVIEW_SQL):
+                seen_any = True
+                if r['chat_id'] != current_chat:
+                    if current_chat is not None:
+                        flush_chat(current_chat, open_pings, closed_pings)
+                    current_chat = r['chat_id']
+                    open_pings, closed_pings = [], []
+                if r['close_ts'] is None:
+                    open_pings.append(r)
+                else:
+                    closed_pings.append(r)
+
+        if current_chat is not None:
+            flush_chat(current_chat, open_pings, closed_pings)
+
+        if not seen_any:
+            print("📋 В базе нет пингов.")
+    finally:
+        await conn.close()
+
+
+if __name__ == "__main__":
+    asyncio.run(check_open_pings())